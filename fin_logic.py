@@ -1,70 +1,203 @@
-import json
+import asyncio
+import hashlib
+import os
 import re
-import easyocr
-from langchain_ollama import ChatOllama
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+import threading
+from collections import OrderedDict
+import cv2
+import httpx
+import numpy as np
+import orjson
+
+try:
+    # The `regex` module supports possessive quantifiers, which stop the text
+    # pattern from backtracking through long digit runs; `re` is the fallback.
+    import regex as _text_re
+    _MONEY_TEXT_PATTERN = r"((?:(?:[$S€£₹]|INR|USD|EUR|GBP)\s?+)?+[\d,]++(?:\.\d{1,2})?+%?)"
+except ImportError:
+    _text_re = re
+    _MONEY_TEXT_PATTERN = r"((?:(?:[$S€£₹]|INR|USD|EUR|GBP)\s?)?[\d,]+(?:\.\d{1,2})?%?)"
 
 
 # --- Part 1: AI and Model Configuration ---
-print("Loading EasyOCR and LLM models...")
-reader = easyocr.Reader(['en'])
-# IMPORTANT: format="json" helps ensure the LLM provides valid JSON
-llm = ChatOllama(model="phi3:3.8b", temperature=0, format="json")
-print("Models loaded.")
+# Any OpenAI-compatible chat endpoint works: Ollama (default) or a llama.cpp
+# `llama-server` started with e.g. `-m phi3-3.8b-q4_k_m.gguf --port 8080 --parallel 4 -cb`.
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://localhost:11434")
+# Q4_K_M rather than the plain `phi3:3.8b` tag (Q4_0): slightly larger weights
+# (~2.4 GB vs ~2.2 GB) for better quantization quality, not faster decoding
+LLM_MODEL = os.getenv("LLM_MODEL", "phi3:3.8b-mini-4k-instruct-q4_K_M")
+# "easyocr" (default) or "paddle"; PaddleOCR is faster on CPU but is an optional install
+OCR_BACKEND = os.getenv("OCR_BACKEND", "easyocr")
+
+class PaddleReader:
+    """Wraps PaddleOCR so readtext() returns EasyOCR-style (bbox, text, conf) tuples."""
+
+    def __init__(self):
+        from paddleocr import PaddleOCR
+        self._ocr = PaddleOCR(use_angle_cls=False, lang='en', show_log=False)
+        # OCR runs in the default thread pool (see main.py), but Paddle's inference
+        # predictor is not thread-safe, so concurrent requests take turns on it
+        self._lock = threading.Lock()
+
+    def readtext(self, image, paragraph=False):
+        # PaddleOCR 2.6+ returns one result list per page (None when nothing is found),
+        # each line as [bbox, (text, conf)] with the same corner order as EasyOCR
+        # Images arrive as RGB (see decode_image); PaddleOCR expects OpenCV's BGR order
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        with self._lock:
+            pages = self._ocr.ocr(image, cls=False)
+        lines = pages[0] if pages else None
+        return [(bbox, text, conf) for bbox, (text, conf) in lines or []]
+
+# Process-wide singletons, created on first use (or by load_models() at startup)
+# rather than at import time. The reader is also requested from OCR worker
+# threads, so its lazy initialization is locked to avoid building it twice.
+reader = None
+llm_client = None
+_READER_LOCK = threading.Lock()
+_LLM_CLIENT_LOCK = threading.Lock()
+
+def get_reader():
+    """Loads the OCR reader once per process and returns it."""
+    global reader
+    if reader is None:
+        with _READER_LOCK:
+            if reader is None:
+                print(f"Loading OCR model ({OCR_BACKEND})...")
+                if OCR_BACKEND == "paddle":
+                    reader = PaddleReader()
+                elif OCR_BACKEND == "easyocr":
+                    # Imported here, like PaddleOCR, so either backend can be installed on its own
+                    import easyocr
+                    reader = easyocr.Reader(['en'])
+                else:
+                    raise ValueError(f"Unknown OCR_BACKEND '{OCR_BACKEND}', expected 'easyocr' or 'paddle'.")
+                print("OCR model loaded.")
+    return reader
+
+def get_llm_client():
+    """Creates the shared LLM HTTP client once per process and returns it."""
+    global llm_client
+    if llm_client is None:
+        with _LLM_CLIENT_LOCK:
+            if llm_client is None:
+                llm_client = httpx.AsyncClient(base_url=LLM_BASE_URL, timeout=120.0)
+    return llm_client
+
+def load_models():
+    """Loads the OCR reader and LLM client up front and returns them."""
+    return get_reader(), get_llm_client()
+
+async def close_models():
+    """Releases the LLM client's connection pool; the next use starts fresh."""
+    global reader, llm_client
+    if llm_client is not None:
+        await llm_client.aclose()
+    reader = None
+    llm_client = None
+
+# OCR results keyed by a hash of the image bytes, so re-uploads of the same
+# image skip reader.readtext. Oldest entries are evicted past _OCR_CACHE_MAX.
+# The lock guards it because OCR runs in worker threads (see main.py).
+_OCR_CACHE: "OrderedDict[str, list]" = OrderedDict()
+_OCR_CACHE_MAX = 128
+_OCR_CACHE_LOCK = threading.Lock()
 
 
 # --- Part 2: Core Logic ---
 
+# Compiled once at import time; these run for every OCR fragment / text request.
+_MONEY_BBOX_RE = re.compile(r"([$S€£₹]|INR|USD|EUR|GBP)\s?([\d,OolISZgqB.]+)")
+# First characters _MONEY_BBOX_RE can match; any other fragment is skipped without the regex.
+# (A digit check would not work: fully misread amounts such as "$lOO" contain no digits.)
+_MONEY_BBOX_FIRST_CHARS = frozenset("$S€£₹IUEG")
+_MONEY_TEXT_RE = _text_re.compile(_MONEY_TEXT_PATTERN)
+# Every text amount contains a digit or comma; text without one can skip the scan.
+_HAS_NUMBER_RE = re.compile(r"[\d,]")
+
+# Common OCR misreads of digits, applied in a single str.translate pass.
+_OCR_FIX_TBL = str.maketrans({
+    'O': '0', 'o': '0', 'l': '1', 'I': '1', 'Z': '2',
+    'g': '9', 'q': '9', 'B': '8'
+})
+
 def clean_monetary_value(value: str) -> str:
     """Corrects common OCR errors in a string that represents a number."""
-    symbol = value[0]
-    numeric_part = value[1:]
-    corrections = {
-        'O': '0', 'o': '0', 'l': '1', 'I': '1', 'Z': '2',
-        'g': '9', 'q': '9', 'B': '8'
-    }
-    for error, correction in corrections.items():
-        numeric_part = numeric_part.replace(error, correction)
-    return f"{symbol}{numeric_part}"
+    return f"{value[0]}{value[1:].translate(_OCR_FIX_TBL)}"
+
+def decode_image(image_bytes: bytes):
+    """
+    Decodes uploaded PNG/JPEG bytes into an RGB array, the same form EasyOCR
+    converts raw bytes into internally.
+    """
+    # cv2.imdecode asserts on an empty buffer instead of returning None
+    if not image_bytes:
+        raise ValueError("Could not decode the uploaded file as an image.")
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode the uploaded file as an image.")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
 def extract_contextual_amounts(image_bytes: bytes):
     """
     Performs OCR, finds monetary amounts, cleans them, and identifies their context.
     """
-    all_fragments = reader.readtext(image_bytes, paragraph=False)
-    
-    money_pattern = r"(\$|S|€|£|₹|INR|USD|EUR|GBP)\s?([\d,OolISZgqB\.]+)"
+    # blake2b is faster than sha1 here, and the key needs no cryptographic strength
+    key = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    with _OCR_CACHE_LOCK:
+        all_fragments = _OCR_CACHE.get(key)
+        if all_fragments is not None:
+            _OCR_CACHE.move_to_end(key)
+    if all_fragments is None:
+        all_fragments = get_reader().readtext(decode_image(image_bytes), paragraph=False)
+        with _OCR_CACHE_LOCK:
+            _OCR_CACHE[key] = all_fragments
+            if len(_OCR_CACHE) > _OCR_CACHE_MAX:
+                _OCR_CACHE.popitem(last=False)
     
-    amount_fragments = []
-    other_fragments = []
+    # Keep fragments as parallel columns (text, y-center, x-edge) rather than one
+    # dict per fragment, so the arrays below are built without per-item lookups.
+    amount_texts, amount_y_centers, amount_x_lefts = [], [], []
+    other_texts, other_y_centers, other_x_rights = [], [], []
 
     for bbox, text, conf in all_fragments:
-        if re.fullmatch(money_pattern, text):
-            amount_fragments.append({"bbox": bbox, "text": text})
+        y_center = (bbox[0][1] + bbox[2][1]) / 2
+        if text[:1] in _MONEY_BBOX_FIRST_CHARS and _MONEY_BBOX_RE.fullmatch(text):
+            amount_texts.append(text)
+            amount_y_centers.append(y_center)
+            amount_x_lefts.append(bbox[0][0])
         else:
-            other_fragments.append({"bbox": bbox, "text": text})
+            other_texts.append(text)
+            other_y_centers.append(y_center)
+            other_x_rights.append(bbox[1][0])
+
+    # Each amount's label is the closest fragment to its left on the same line.
+    # Compare every (amount, other) pair at once instead of a nested Python loop.
+    ay_center = np.array(amount_y_centers, dtype=float)
+    ax_left = np.array(amount_x_lefts, dtype=float)
+    oy_center = np.array(other_y_centers, dtype=float)
+    ox_right = np.array(other_x_rights, dtype=float)
+
+    distances = ax_left[:, None] - ox_right[None, :]
+    mask = (np.abs(ay_center[:, None] - oy_center[None, :]) < 20) & (distances > 0)
+    distances[~mask] = np.inf
+
+    if other_texts:
+        best_index = distances.argmin(axis=1)
+        has_candidate = np.isfinite(distances.min(axis=1))
+    else:
+        best_index = np.zeros(len(amount_texts), dtype=int)
+        has_candidate = np.zeros(len(amount_texts), dtype=bool)
 
     contextual_amounts = []
-    for amount in amount_fragments:
-        ay_center = (amount["bbox"][0][1] + amount["bbox"][2][1]) / 2
-        ax_left = amount["bbox"][0][0]
-        best_candidate = None
-        min_distance = float('inf')
-
-        for other in other_fragments:
-            oy_center = (other["bbox"][0][1] + other["bbox"][2][1]) / 2
-            ox_right = other["bbox"][1][0]
-            if abs(ay_center - oy_center) < 20 and ox_right < ax_left:
-                distance = ax_left - ox_right
-                if distance < min_distance:
-                    min_distance = distance
-                    best_candidate = other["text"]
-        
-        cleaned_amount = clean_monetary_value(amount["text"])
+    for amount_text, index, found in zip(amount_texts, best_index, has_candidate):
+        best_candidate = other_texts[index] if found else None
+        cleaned_amount = clean_monetary_value(amount_text)
         contextual_amounts.append({
             "amount": cleaned_amount,
-            "context": best_candidate or "Unknown"
+            "context": best_candidate or "Unknown",
+            # A neighbouring OCR fragment is a field label in its own right
+            "context_is_label": bool(best_candidate)
         })
     print(contextual_amounts)
     return contextual_amounts
@@ -72,12 +205,11 @@ def extract_contextual_amounts(image_bytes: bytes):
 def extract_contextual_amounts_from_text(text_input: str):
     """Processes a TEXT STRING to find amounts and their sequential context."""
     contextual_amounts = []
-    money_pattern = re.compile(
-        r"((?:(?:\$|S|€|£|₹|INR|USD|EUR|GBP)\s?)?[\d,]+(?:\.\d{1,2})?%?)"
-    )
+    if not _HAS_NUMBER_RE.search(text_input):
+        return contextual_amounts
 
-    # Use re.finditer to get the position of each match
-    for match in re.finditer(money_pattern, text_input):
+    # Use finditer to get the position of each match
+    for match in _MONEY_TEXT_RE.finditer(text_input):
         amount_text = match.group(0)
         
         # Look at the text immediately before the match
@@ -91,22 +223,73 @@ def extract_contextual_amounts_from_text(text_input: str):
         cleaned_amount = clean_monetary_value(amount_text)
         contextual_amounts.append({
             "amount": cleaned_amount,
-            "context": best_candidate
+            "context": best_candidate,
+            # Free text only reads as "Label: amount" when the words end with a colon
+            "context_is_label": best_candidate.endswith(":")
         })
         
     return contextual_amounts
 
-def label_amounts_with_llm(contextual_data: list):
+# JSON schema for the labeled output. The LLM server turns it into a sampling
+# grammar (GBNF on llama.cpp), so every decoded token stays inside valid JSON.
+_LABELED_AMOUNTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "currency": {"type": "string"},
+        "amounts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "type": {"type": "string"},
+                    "value": {"type": "number"},
+                    "source": {"type": "string"}
+                },
+                "required": ["type", "value", "source"]
+            }
+        },
+        "status": {"type": "string", "enum": ["ok"]}
+    },
+    "required": ["currency", "amounts", "status"]
+}
+
+# Currency symbols and codes for the rule-based fast path; "S" is an OCR misread of "$"
+_CURRENCY_CODES = {
+    '$': 'USD', 'S': 'USD', '€': 'EUR', '£': 'GBP', '₹': 'INR',
+    'USD': 'USD', 'EUR': 'EUR', 'GBP': 'GBP', 'INR': 'INR'
+}
+_SIMPLE_AMOUNT_RE = re.compile(
+    r"([$S€£₹]|INR|USD|EUR|GBP)\s?(\d{1,3}(?:,\d{3})*(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?)"
+)
+_NON_WORD_RE = re.compile(r"[^0-9a-zA-Z]+")
+
+def _label_single_amount(item: dict):
     """
-    Uses an LLM to assign clean labels and format the final JSON output.
+    Labels a single amount without the LLM when its currency, value and context are
+    unambiguous: a well-formed amount next to something that reads as a field label.
+    Returns None if the item needs the LLM.
     """
-    if not contextual_data:
-        return {"status": "no_amounts_found", "reason": "OCR found no amounts to process."}
-        
-    context_string = "\n".join([f"- Amount: {item['amount']}, Nearby Text: {item['context']}" for item in contextual_data])
-    
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """You are a highly intelligent data extraction bot. Your task is to analyze the user's text, which contains monetary amounts and their nearby context, and transform it into a specific JSON format.
+    if not item.get("context_is_label"):
+        return None
+    match = _SIMPLE_AMOUNT_RE.fullmatch(item["amount"])
+    context = item["context"].rstrip(": ")
+    label = _NON_WORD_RE.sub("_", context).strip("_").lower()
+    if not match or not label:
+        return None
+
+    number = match.group(2).replace(",", "")
+    value = float(number) if "." in number else int(number)
+    return {
+        "currency": _CURRENCY_CODES[match.group(1)],
+        "amounts": [
+            {"type": label, "value": value, "source": f"text: '{context}: {item['amount']}'"}
+        ],
+        "status": "ok"
+    }
+
+# The system prompt and the rest of the request body are the same for every
+# call, so build them once at import time instead of per request.
+_SYSTEM_PROMPT = """You are a highly intelligent data extraction bot. Your task is to analyze the user's text, which contains monetary amounts and their nearby context, and transform it into a specific JSON format.
 
         Follow these rules precisely:
         1.  **Top-Level Currency:** Determine the single currency for the entire document (e.g., USD, INR, EUR) and place it in the top-level "currency" key. if the identified currency is S, treat it as USD.
@@ -124,33 +307,186 @@ def label_amounts_with_llm(contextual_data: list):
         - Amount: ₹200, Nearby Text: Due
 
         Your JSON Output: 
-       {{
+       {
     "currency": "INR",
     "amounts": [
-        {{"type": "total", "value": 1200, "source": "text: 'Total: ₹1200'"}},
-        {{"type": "paid", "value": 1000, "source": "text: 'Paid: ₹1000'"}},
-        {{"type": "due", "value": 200, "source": "text: 'Due: ₹200'"}}
+        {"type": "total", "value": 1200, "source": "text: 'Total: ₹1200'"},
+        {"type": "paid", "value": 1000, "source": "text: 'Paid: ₹1000'"},
+        {"type": "due", "value": 200, "source": "text: 'Due: ₹200'"}
     ],
     "status": "ok"
-    }}
+    }
          
-        """),
-        ("human", "{context_string}")
-    ])
-    
-    chain = prompt | llm | StrOutputParser()
-    response_str = chain.invoke({"context_string": context_string})
+        """
+
+_LLM_REQUEST_BASE = {
+    "model": LLM_MODEL,
+    "temperature": 0,
+    # IMPORTANT: the json_schema response_format constrains decoding to the expected structure
+    "response_format": {
+        "type": "json_schema",
+        "json_schema": {"name": "labeled_amounts", "schema": _LABELED_AMOUNTS_SCHEMA}
+    },
+    # llama-server keeps the KV cache of the shared system-prompt prefix between requests
+    "cache_prompt": True,
+}
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Batch prompting: several invoices share one prompt, so the fixed instructions
+# are prefilled once per batch instead of once per invoice.
+_BATCH_SYSTEM_PROMPT = _SYSTEM_PROMPT + """
+        **BATCH INPUT:** The user's text may contain several invoices, each starting with "Invoice #N:".
+        Apply the rules above to each invoice separately, and return a single JSON object whose "invoices" key
+        is a list with exactly one output object per invoice, in the same order.
+
+        **BATCH EXAMPLE:**
+        Human Input:
+        Invoice #1:
+        - Amount: ₹1200, Nearby Text: Total
+        - Amount: ₹200, Nearby Text: Due
+        Invoice #2:
+        - Amount: $50.00, Nearby Text: SUB TOTAL
+        - Amount: $5.00, Nearby Text: Tax
+
+        Your JSON Output:
+       {
+    "invoices": [
+        {
+        "currency": "INR",
+        "amounts": [
+            {"type": "total", "value": 1200, "source": "text: 'Total: ₹1200'"},
+            {"type": "due", "value": 200, "source": "text: 'Due: ₹200'"}
+        ],
+        "status": "ok"
+        },
+        {
+        "currency": "USD",
+        "amounts": [
+            {"type": "sub_total", "value": 50.00, "source": "text: 'SUB TOTAL: $50.00'"},
+            {"type": "tax", "value": 5.00, "source": "text: 'Tax: $5.00'"}
+        ],
+        "status": "ok"
+        }
+    ]
+    }
+
+        """
+
+# Invoices per batch prompt. Keeps prompt plus output well inside the 4k context
+# of the default model; larger requests are split into concurrent chunks.
+_BATCH_SIZE = 6
+# Status codes where the batch prompt itself is the problem (e.g. context overflow),
+# so retrying the invoices one by one can succeed. Anything else is re-raised.
+_BATCH_FALLBACK_STATUS = {400, 413, 422}
+
+def _batch_request_base(size: int) -> dict:
+    """Request body for a batch of exactly `size` invoices; the schema pins the array length."""
+    return {
+        **_LLM_REQUEST_BASE,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "labeled_invoices",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "invoices": {
+                            "type": "array",
+                            "items": _LABELED_AMOUNTS_SCHEMA,
+                            "minItems": size,
+                            "maxItems": size
+                        }
+                    },
+                    "required": ["invoices"]
+                }
+            }
+        },
+    }
+
+_BATCH_REQUEST_BASES = {size: _batch_request_base(size) for size in range(1, _BATCH_SIZE + 1)}
+_BATCH_SYSTEM_MESSAGE = {"role": "system", "content": _BATCH_SYSTEM_PROMPT}
+
+def _label_without_llm(contextual_data: list):
+    """Returns the final output for inputs that don't need the LLM, else None."""
+    if not contextual_data:
+        return {"status": "no_amounts_found", "reason": "OCR found no amounts to process."}
+
+    # A lone, cleanly parsed amount doesn't need the LLM at all
+    if len(contextual_data) == 1:
+        return _label_single_amount(contextual_data[0])
+    return None
+
+def _format_contextual_data(contextual_data: list) -> str:
+    return "\n".join([f"- Amount: {item['amount']}, Nearby Text: {item['context']}" for item in contextual_data])
+
+async def _chat_completion(request_base: dict, system_message: dict, content: str) -> str:
+    """Sends one chat completion request and returns the model's raw reply text."""
+    response = await get_llm_client().post("/v1/chat/completions", headers=_JSON_HEADERS, content=orjson.dumps({
+        **request_base,
+        "messages": [system_message, {"role": "user", "content": content}],
+    }))
+    response.raise_for_status()
+    return orjson.loads(response.content)["choices"][0]["message"]["content"]
+
+async def label_amounts_with_llm(contextual_data: list):
+    """
+    Uses an LLM to assign clean labels and format the final JSON output.
+    """
+    labeled_data = _label_without_llm(contextual_data)
+    if labeled_data is not None:
+        return labeled_data
+        
+    context_string = _format_contextual_data(contextual_data)
+    response_str = await _chat_completion(_LLM_REQUEST_BASE, _SYSTEM_MESSAGE, context_string)
     
     try:
-        start_index = response_str.find('{')
-        end_index = response_str.rfind('}')
-        if start_index != -1 and end_index != -1:
-            clean_json_str = response_str[start_index : end_index + 1]
-            return json.loads(clean_json_str)
-        else:
-            raise json.JSONDecodeError("No JSON object found in the response.", response_str, 0)
-    except json.JSONDecodeError:
+        return orjson.loads(response_str)
+    except orjson.JSONDecodeError:
         return {"status": "error", "reason": "LLM returned invalid JSON.", "raw_output": response_str}
+
+async def _label_invoice_chunk(chunk: list):
+    """
+    Labels up to _BATCH_SIZE invoices with one batch prompt. If the server rejects the
+    prompt or the result doesn't line up with the input, each invoice is retried on its
+    own instead. Connection errors, timeouts and other HTTP errors propagate, since
+    per-invoice retries would fail the same way.
+    """
+    batch_string = "\n".join(
+        f"Invoice #{n}:\n{_format_contextual_data(contextual_data)}"
+        for n, contextual_data in enumerate(chunk, start=1)
+    )
+    try:
+        response_str = await _chat_completion(_BATCH_REQUEST_BASES[len(chunk)], _BATCH_SYSTEM_MESSAGE, batch_string)
+        batch_data = orjson.loads(response_str)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code not in _BATCH_FALLBACK_STATUS:
+            raise
+        batch_data = None
+    except orjson.JSONDecodeError:
+        batch_data = None
+
+    invoices = batch_data.get("invoices") if isinstance(batch_data, dict) else None
+    if isinstance(invoices, list) and len(invoices) == len(chunk):
+        return invoices
+    return await asyncio.gather(*[label_amounts_with_llm(contextual_data) for contextual_data in chunk])
+
+async def label_amounts_batch_with_llm(contextual_data_list: list):
+    """
+    Labels several invoices with batch prompting (_BATCH_SIZE invoices per LLM call,
+    calls run concurrently) and returns one final JSON output per invoice, in input order.
+    """
+    results = [_label_without_llm(contextual_data) for contextual_data in contextual_data_list]
+    pending = [i for i, result in enumerate(results) if result is None]
+    chunks = [pending[start : start + _BATCH_SIZE] for start in range(0, len(pending), _BATCH_SIZE)]
+
+    chunk_results = await asyncio.gather(*[
+        _label_invoice_chunk([contextual_data_list[i] for i in chunk]) for chunk in chunks
+    ])
+    for chunk, invoices in zip(chunks, chunk_results):
+        for i, labeled_data in zip(chunk, invoices):
+            results[i] = labeled_data
+    return results
     
 
 
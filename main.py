@@ -1,14 +1,23 @@
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List
+from uuid import uuid4
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from pydantic import BaseModel
+import asyncio
+import os
+import orjson
 import uvicorn
-import json
 
 # Import the logic functions from your logic.py file
 try:
     from fin_logic import (
         extract_contextual_amounts, 
         extract_contextual_amounts_from_text, 
-        label_amounts_with_llm
+        label_amounts_with_llm,
+        label_amounts_batch_with_llm,
+        load_models,
+        close_models
     )
 except ImportError:
     print("CRITICAL: Could not import from logic.py. Ensure the file exists and has no syntax errors.")
@@ -16,12 +25,38 @@ except ImportError:
     extract_contextual_amounts = None
     extract_contextual_amounts_from_text = None
     label_amounts_with_llm = None
+    label_amounts_batch_with_llm = None
+    load_models = None
+    close_models = None
 
 # --- Part 1: FastAPI App and Request Models ---
 
+# Set DEBUG_DUMP=1 (or true/yes) to save the intermediate and final JSON of each text request under debug/
+DEBUG_DUMP = os.getenv("DEBUG_DUMP", "").strip().lower() in ("1", "true", "yes")
+DEBUG_DIR = Path("debug")
+
+# Upper bound on texts per /process-batch-text/ call, which keeps the concurrent LLM
+# calls of one request (8 chunks of 6) well inside the HTTP client's connection pool
+MAX_BATCH_TEXTS = 48
+
+def write_debug_dump(filename: str, data):
+    """Writes one debug JSON file; run via asyncio.to_thread so disk I/O stays off the event loop."""
+    DEBUG_DIR.mkdir(exist_ok=True)
+    (DEBUG_DIR / filename).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Loads the OCR and LLM models once at startup, before the first request arrives."""
+    if load_models:
+        load_models()
+    yield
+    if close_models:
+        await close_models()
+
 app = FastAPI(
     title="Intelligent Invoice Processor API",
-    description="An API that uses OCR and an LLM to extract labeled monetary amounts from images and text."
+    description="An API that uses OCR and an LLM to extract labeled monetary amounts from images and text.",
+    lifespan=lifespan
 )
 
 class TextRequest(BaseModel):
@@ -48,10 +83,14 @@ async def process_invoice_image(file: UploadFile = File(..., description="The in
     image_bytes = await file.read()
     
     # Step 1: Extract contextual data from the image
-    contextual_data = extract_contextual_amounts(image_bytes)
+    # OCR is blocking, so run it in a worker thread to keep the event loop free for other requests
+    try:
+        contextual_data = await asyncio.to_thread(extract_contextual_amounts, image_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Step 2: Use the LLM to get the final labeled JSON
-    labeled_data = label_amounts_with_llm(contextual_data)
+    labeled_data = await label_amounts_with_llm(contextual_data)
     
     return labeled_data
 
@@ -67,15 +106,38 @@ async def process_invoice_text(request: TextRequest):
     # Step 1: Extract contextual data from the provided text
     contextual_data = extract_contextual_amounts_from_text(request.text)
     
-    with open("process_text.json", 'w') as f:
-        json.dump(contextual_data, f, indent=4)
+    # A unique prefix per request keeps concurrent requests from overwriting each other.
+    # The extracted amounts are dumped before the LLM call so they survive an LLM failure.
+    dump_id = uuid4().hex
+    if DEBUG_DUMP:
+        await asyncio.to_thread(write_debug_dump, f"{dump_id}_process_text.json", contextual_data)
+
     # Step 2: Use the LLM to get the final labeled JSON
-    labeled_data = label_amounts_with_llm(contextual_data)
-    with open("labelled_text.json", 'w') as f:
-        json.dump(labeled_data, f, indent=4)
+    labeled_data = await label_amounts_with_llm(contextual_data)
+    if DEBUG_DUMP:
+        await asyncio.to_thread(write_debug_dump, f"{dump_id}_labelled_text.json", labeled_data)
     
     return labeled_data
 
+@app.post("/process-batch-text/", summary="Process Multiple Invoice Texts")
+async def process_invoice_text_batch(requests: List[TextRequest]):
+    """
+    Accepts a JSON list of objects with a 'text' field and labels the invoices up to
+    6 at a time per LLM call (batch prompting), with the batches sent concurrently.
+    Returns one labeled JSON output per input, in order.
+    """
+    if not all([extract_contextual_amounts_from_text, label_amounts_batch_with_llm]):
+        raise HTTPException(status_code=503, detail="Server logic is not available or failed to load.")
+    if len(requests) > MAX_BATCH_TEXTS:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {MAX_BATCH_TEXTS} texts.")
+
+    # Step 1: Extract contextual data from every text
+    contextual_data_list = [extract_contextual_amounts_from_text(request.text) for request in requests]
+
+    # Step 2: Batch-prompt the LLM in concurrent chunks; a chunk whose result can't be
+    # matched to its invoices is retried one invoice at a time
+    return await label_amounts_batch_with_llm(contextual_data_list)
+
 if __name__ == "__main__":
     # This makes the script runnable with "python main.py"
     uvicorn.run(app, host="0.0.0.0", port=8000)